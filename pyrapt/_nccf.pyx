@@ -0,0 +1,92 @@
+# cython: language_level=2
+"""
+Optional Cython build of the NCCF inner loops used by pyrapt. It is compiled
+by setup.py when Cython is installed, otherwise pyrapt falls back to numba or
+numpy implementations of the same math.
+"""
+
+cimport cython
+from libc.math cimport sqrt
+
+import numpy
+
+
+# audio is stored as float32 by pyrapt, sums over it are done in double
+ctypedef fused audio_t:
+    float
+    double
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def nccf_frame(audio_t[::1] audio, Py_ssize_t frame_start, Py_ssize_t n,
+               Py_ssize_t k_start, Py_ssize_t k_end, double additive_constant):
+    """
+    NCCF for lags k_start to k_end - 1 of one frame, with the same results as
+    pyrapt's numba kernel. Returns the correlation per lag and the largest of
+    those values.
+    """
+    cdef Py_ssize_t j, k
+    cdef double x, y, acc_xy, acc_yy, denominator
+    cdef double mean_for_window = 0.0
+    cdef double acc_xx = 0.0
+    cdef double max_val = 0.0
+
+    if k_start < 0 or frame_start + k_end - 1 + n > audio.shape[0]:
+        raise IndexError('lag samples run past the end of the audio')
+
+    correlations_array = numpy.zeros(k_end - k_start)
+    cdef double[::1] correlations = correlations_array
+
+    # the loops only touch typed memoryviews and C doubles, so they run w/o
+    # the GIL and frames in other threads can be correlated at the same time
+    with nogil:
+        for j in range(n):
+            mean_for_window += audio[frame_start + j]
+        mean_for_window /= n
+
+        for j in range(n):
+            x = audio[frame_start + j] - mean_for_window
+            acc_xx += x * x
+
+        for k in range(k_start, k_end):
+            acc_xy = 0.0
+            acc_yy = 0.0
+            for j in range(n):
+                x = audio[frame_start + j] - mean_for_window
+                y = audio[frame_start + k + j] - mean_for_window
+                acc_xy += x * y
+                acc_yy += y * y
+            denominator = acc_xx * acc_yy + additive_constant
+            if denominator > 0.0:
+                correlations[k - k_start] = acc_xy / sqrt(denominator)
+                if correlations[k - k_start] > max_val:
+                    max_val = correlations[k - k_start]
+
+    return (correlations_array, max_val)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def lag_sums(audio_t[::1] audio, Py_ssize_t lag_start,
+             double[::1] centered_window, double mean_for_window):
+    """
+    Returns the NCCF numerator and lag energy for the samples starting at
+    lag_start, against a frame's window already centered on its mean.
+    """
+    cdef Py_ssize_t j
+    cdef Py_ssize_t n = centered_window.shape[0]
+    cdef double y
+    cdef double acc_xy = 0.0
+    cdef double acc_yy = 0.0
+
+    if lag_start < 0 or lag_start + n > audio.shape[0]:
+        raise IndexError('lag samples run past the end of the audio')
+
+    with nogil:
+        for j in range(n):
+            y = audio[lag_start + j] - mean_for_window
+            acc_xy += centered_window[j] * y
+            acc_yy += y * y
+    return (acc_xy, acc_yy)
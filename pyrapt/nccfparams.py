@@ -22,3 +22,6 @@ class Nccfparams:
 
         # Value of "M-1" in NCCF equation
         self.max_frame_count = None
+
+        # Running sum of audio samples (w/ leading 0) used for window means
+        self.cumulative_audio_sum = None
@@ -3,6 +3,9 @@ This module encapsulates the rapt function, which runs a pitch tracker
 based on David Talkin's Robust Algorithm for Pitch Tracking (RAPT).
 """
 
+from distutils.version import LooseVersion
+import fractions
+import heapq
 import math
 import numpy
 from scipy import signal
@@ -11,6 +14,40 @@ from scipy.io import wavfile
 import raptparams
 import nccfparams
 
+# numba is optional - when it is installed the per-frame NCCF kernel below is
+# JIT compiled, otherwise the FFT based numpy implementation is used instead
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# joblib is optional - when it is installed NCCF frames are processed in
+# parallel threads, otherwise one frame at a time. Thread based Parallel
+# (prefer='threads') needs joblib 0.12+, so older versions aren't used
+try:
+    import joblib
+except ImportError:
+    joblib = None
+if (joblib is not None and
+        LooseVersion(joblib.__version__) < LooseVersion('0.12')):
+    joblib = None
+
+# cupy is optional - when it is installed the batched NCCF of long audio
+# samples runs on the GPU
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+# _nccf is the optional Cython build of the NCCF inner loops (compiled by
+# setup.py when Cython is installed)
+try:
+    import _nccf
+except ImportError:
+    _nccf = None
+# sample types the Cython kernel is built for
+_NCCF_KERNEL_DTYPES = (numpy.float32, numpy.float64)
+
 
 def rapt(wavfile_path, **kwargs):
     """
@@ -27,7 +64,8 @@ def rapt(wavfile_path, **kwargs):
         # downsample audio and run nccf on that first
         downsampled_audio = _get_downsampled_audio(original_audio,
                                                    param.maximum_allowed_freq,
-                                                   param.is_run_filter)
+                                                   param.is_run_filter,
+                                                   param.is_polyphase_resample)
         # calculate parameters for RAPT with input audio
         _calculate_params(param, original_audio, downsampled_audio)
         # get f0 candidates using nccf
@@ -64,7 +102,8 @@ def rapt_with_nccf(wavfile_path, **kwargs):
     if param.is_two_pass_nccf:
         downsampled_audio = _get_downsampled_audio(original_audio,
                                                    param.maximum_allowed_freq,
-                                                   param.is_run_filter)
+                                                   param.is_run_filter,
+                                                   param.is_polyphase_resample)
         # calculate parameters for RAPT with input audio
         _calculate_params(param, original_audio, downsampled_audio)
         # get f0 candidates using nccf
@@ -119,10 +158,15 @@ def _get_audio_data(wavfile_path):
         audio_sample = audio_sample[:, 0]/2.0 + audio_sample[:, 1]/2.0
         audio_sample = audio_sample.astype(int)
 
-    return (sample_rate, audio_sample)
+    # keep samples as a float32 ndarray from here on so NCCF and RMS slices
+    # never need converting from the wav file's integer type. float32 holds
+    # 16-bit samples exactly at half the memory of float64 - sums over the
+    # samples are still accumulated in float64:
+    return (sample_rate, audio_sample.astype(numpy.float32))
 
 
-def _get_downsampled_audio(original_audio, maximum_allowed_freq, is_filter):
+def _get_downsampled_audio(original_audio, maximum_allowed_freq, is_filter,
+                           is_polyphase=True):
     """
     Calc downsampling rate, downsample audio, return as tuple
     """
@@ -136,27 +180,38 @@ def _get_downsampled_audio(original_audio, maximum_allowed_freq, is_filter):
                                window='hanning')
         filtered_audio = signal.lfilter(filter, 1, original_audio[1])
         filtered_audio = (original_audio[0], filtered_audio)
-        downsampled_audio = _downsample_audio(filtered_audio, downsample_rate)
+        downsampled_audio = _downsample_audio(filtered_audio, downsample_rate,
+                                              is_polyphase)
     else:
-        downsampled_audio = _downsample_audio(original_audio, downsample_rate)
+        downsampled_audio = _downsample_audio(original_audio, downsample_rate,
+                                              is_polyphase)
 
     return (downsample_rate, downsampled_audio)
 
 
-def _downsample_audio(original_audio, downsampling_rate):
+def _downsample_audio(original_audio, downsampling_rate, is_polyphase=True):
     """
     Given the original audio sample/rate and a desired downsampling
     rate, returns a downsampled version of the audio input.
     """
-    # TODO: look into applying low pass filter prior to downsampling, as
-    # suggested in rapt paper.
-    try:
-        sample_rate_ratio = float(downsampling_rate) / float(original_audio[0])
-    except ZeroDivisionError:
+    if not original_audio[0]:
         raise ValueError('Input audio sampling rate is zero. Cannot determine '
                          'downsampling ratio.')
-    # resample audio so it only uses a fraction of the original # of samples:
-    number_of_samples = len(original_audio[1]) * sample_rate_ratio
+
+    if is_polyphase:
+        # polyphase resampling runs an anti-aliasing low pass filter as part
+        # of the rate change and avoids an FFT over the whole audio sample.
+        # It needs the ratio of the two rates as a fraction of integers:
+        sample_rate_ratio = fractions.Fraction(int(downsampling_rate),
+                                               int(original_audio[0]))
+        return signal.resample_poly(original_audio[1],
+                                    sample_rate_ratio.numerator,
+                                    sample_rate_ratio.denominator)
+
+    # otherwise resample via FFT so the audio only uses a fraction of the
+    # original # of samples:
+    sample_rate_ratio = float(downsampling_rate) / float(original_audio[0])
+    number_of_samples = int(round(len(original_audio[1]) * sample_rate_ratio))
     downsampled_audio = signal.resample(original_audio[1], number_of_samples)
 
     return downsampled_audio
@@ -205,16 +260,16 @@ def _one_pass_nccf(audio, raptparam):
     """
     nccfparam = _get_nccf_params(audio, raptparam, True)
     params = (raptparam, nccfparam)
+    audio = _as_float_audio(audio)
     # TODO: do i really use a -1 here?
     # Difference between "K-1" and starting value of "k"
     lag_range = ((params[1].longest_lag_per_frame - 1) -
                  params[1].shortest_lag_per_frame)
-    candidates = [None] * params[1].max_frame_count
 
-    for i in xrange(0, params[1].max_frame_count):
-        all_lag_results = _get_correlations_for_all_lags(audio, i, lag_range,
-                                                         params)
-        candidates[i] = _get_marked_results(all_lag_results, params, False)
+    all_lag_results = _get_correlations_for_all_frames(audio, lag_range,
+                                                       params)
+    candidates = [_get_marked_results(lag_results, params, False)
+                  for lag_results in all_lag_results]
 
     return candidates
 
@@ -226,6 +281,7 @@ def _first_pass_nccf(audio, raptparam):
 
     nccfparam = _get_nccf_params(audio, raptparam, True)
     params = (raptparam, nccfparam)
+    audio = _as_float_audio(audio)
 
     # Difference between "K-1" and starting value of "k"
     lag_range = ((params[1].longest_lag_per_frame - 1) -
@@ -236,11 +292,12 @@ def _first_pass_nccf(audio, raptparam):
     # NOTE: Because we are using max_frame_count exclusively for array size,
     # we do not run into issues with using xrange to iterate thru each frame, i
 
-    candidates = [None] * params[1].max_frame_count
-
-    for i in xrange(0, params[1].max_frame_count):
-        candidates[i] = _get_firstpass_frame_results(
-            audio, i, lag_range, params)
+    # calculate correlation (theta) for all lags, and get the highest
+    # correlation val (theta_max) from the calculated lags, for every frame:
+    all_lag_results = _get_correlations_for_all_frames(audio, lag_range,
+                                                       params)
+    candidates = [_get_marked_results(lag_results, params, True)
+                  for lag_results in all_lag_results]
 
     return candidates
 
@@ -248,6 +305,7 @@ def _first_pass_nccf(audio, raptparam):
 def _second_pass_nccf(original_audio, first_pass, raptparam):
     # Runs NCCF on original audio, but only for lags highlighted from first
     # pass results. Will output the finalized F0 candidates for each frame
+    original_audio = _as_float_audio(original_audio)
     nccfparam = _get_nccf_params(original_audio, raptparam, False)
     params = (raptparam, nccfparam)
 
@@ -255,15 +313,42 @@ def _second_pass_nccf(original_audio, first_pass, raptparam):
     lag_range = ((params[1].longest_lag_per_frame - 1) -
                  params[1].shortest_lag_per_frame)
 
-    candidates = [None] * params[1].max_frame_count
-
-    for i in xrange(0, params[1].max_frame_count):
-        candidates[i] = _get_secondpass_frame_results(
-            original_audio, i, lag_range, params, first_pass)
+    candidates = _get_results_per_frame(_get_secondpass_frame_results,
+                                        original_audio,
+                                        nccfparam.max_frame_count,
+                                        raptparam.n_jobs, lag_range, params,
+                                        first_pass)
 
     return candidates
 
 
+def _get_results_per_frame(frame_func, audio, frame_count, n_jobs, *args):
+    """
+    Calls frame_func(audio, i, *args) for each frame i in range(frame_count),
+    returning the results in frame order. Frames are independent of each
+    other, so if joblib is available they are spread across n_jobs worker
+    threads.
+    """
+    if not _is_threaded(n_jobs):
+        return [frame_func(audio, i, *args) for i in xrange(0, frame_count)]
+
+    # threads (rather than processes) share the audio array without copying
+    # it, and the heavy NCCF math runs in numpy / numba code free of the GIL
+    return joblib.Parallel(n_jobs=n_jobs, prefer='threads')(
+        joblib.delayed(frame_func)(audio, i, *args)
+        for i in xrange(0, frame_count))
+
+
+def _is_threaded(n_jobs):
+    # whether _get_results_per_frame spreads frames across worker threads
+    return joblib is not None and n_jobs != 1
+
+
+def _as_float_audio(audio):
+    # NCCF kernels expect contiguous float32 samples (no copy if they are)
+    return (audio[0], numpy.ascontiguousarray(audio[1], dtype=numpy.float32))
+
+
 def _get_nccf_params(audio_input, raptparams, is_firstpass):
     """
     Creates and returns nccfparams object w/ nccf-specific values
@@ -288,19 +373,15 @@ def _get_nccf_params(audio_input, raptparams, is_firstpass):
     # Value of "M-1" in NCCF equation:
     nccfparam.max_frame_count = int(round(float(len(audio_input[1])) /
                                     float(nccfparam.samples_per_frame)) - 1)
+    # Running sum of the audio, so each frame's window mean is O(1). Only
+    # the 2nd pass reads it (the all-lags NCCF gets its means elsewhere), so
+    # the float64 copy of the audio isn't made for the other passes:
+    if not is_firstpass:
+        nccfparam.cumulative_audio_sum = numpy.concatenate(
+            ([0.0], numpy.cumsum(audio_input[1], dtype=numpy.float64)))
     return nccfparam
 
 
-def _get_firstpass_frame_results(audio, current_frame, lag_range, params):
-    # calculate correlation (theta) for all lags, and get the highest
-    # correlation val (theta_max) from the calculated lags:
-    all_lag_results = _get_correlations_for_all_lags(audio, current_frame,
-                                                     lag_range, params)
-
-    marked_values = _get_marked_results(all_lag_results, params, True)
-    return marked_values
-
-
 def _get_secondpass_frame_results(audio, current_frame, lag_range, params,
                                   first_pass):
 
@@ -312,57 +393,272 @@ def _get_secondpass_frame_results(audio, current_frame, lag_range, params,
     return marked_values
 
 
-def _get_correlations_for_all_lags(audio, current_frame, lag_range, params):
-    # Value of theta_max in NCCF equation, max for the current frame
+def _get_correlations_for_all_frames(audio, lag_range, params):
+    """
+    Returns the NCCF values for all lags along with their max (theta_max)
+    for every frame of the audio sample
+    """
+    backend = _get_nccf_backend(audio, params)
+    if backend in ('numba', 'cython'):
+        if backend == 'cython':
+            nccf_kernel = _nccf.nccf_frame
+        elif _is_threaded(params[0].n_jobs):
+            # numba's parallel runtime can't be entered from several threads
+            # at once, so frames run in worker threads get the serial build
+            nccf_kernel = _nccf_frame_serial
+        else:
+            nccf_kernel = _nccf_frame
+        return _get_results_per_frame(_get_correlations_for_all_lags, audio,
+                                      params[1].max_frame_count,
+                                      params[0].n_jobs, lag_range, params,
+                                      nccf_kernel)
+
+    # otherwise run blocks of frames through the batched FFT NCCF, on the GPU
+    # (only the correlations of each block are copied back) or with numpy
+    if backend == 'cupy':
+        xp = cupy
+        block_size = _GPU_NCCF_FRAME_BLOCK_SIZE
+    else:
+        xp = numpy
+        block_size = _NCCF_FRAME_BLOCK_SIZE
+    frame_count = params[1].max_frame_count
+    all_lag_results = []
+    for first_frame in xrange(0, frame_count, block_size):
+        block_frame_count = min(block_size, frame_count - first_frame)
+        correlations = _get_frame_block_correlations(audio, first_frame,
+                                                     block_frame_count,
+                                                     lag_range, params, xp)
+        if backend == 'cupy':
+            correlations = cupy.asnumpy(correlations)
+        max_correlation_vals = numpy.maximum(correlations.max(axis=1), 0.0)
+        all_lag_results.extend(zip(correlations.tolist(),
+                                   max_correlation_vals.tolist()))
+    return all_lag_results
+
+
+def _get_nccf_backend(audio, params):
+    # Resolves the nccf_backend param to the backend that will actually run
+    backend = params[0].nccf_backend
+    if backend == 'auto':
+        if (len(audio[1]) >= params[0].gpu_min_sample_count and
+                _is_gpu_available()):
+            return 'cupy'
+        elif numba is not None:
+            return 'numba'
+        return 'cython' if _nccf is not None else 'numpy'
+    elif backend not in ('cupy', 'numba', 'cython', 'numpy'):
+        raise ValueError('Unknown NCCF backend: {}'.format(backend))
+    elif ((backend == 'cupy' and cupy is None) or
+          (backend == 'numba' and numba is None) or
+          (backend == 'cython' and _nccf is None)):
+        raise ValueError('NCCF backend {} is not installed'.format(backend))
+    return backend
+
+
+def _is_gpu_available():
+    # cupy can be installed on machines w/o a CUDA device (or driver), which
+    # only shows up as an error once the first array is put on the GPU
+    if cupy is None:
+        return False
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except Exception:
+        return False
+
+
+def _get_correlations_for_all_lags(audio, current_frame, lag_range, params,
+                                   nccf_kernel=None):
+    # Value of theta_max in NCCF equation, max for the current frame.
+    # nccf_kernel is the compiled per-frame kernel to run (numba's or
+    # Cython's) - without one the frame goes through the numpy batched NCCF
+    if nccf_kernel is None:
+        correlations = _get_frame_block_correlations(audio, current_frame, 1,
+                                                     lag_range, params)[0]
+        return (correlations.tolist(), max(0.0, correlations.max()))
+
     candidates = [0.0] * lag_range
     max_correlation_val = 0.0
-    for k in xrange(0, lag_range):
-        current_lag = k + params[1].shortest_lag_per_frame
+    samples_correlated_per_lag = params[1].samples_correlated_per_lag
+    frame_start = current_frame * params[1].samples_per_frame
+    first_lag = params[1].shortest_lag_per_frame
+
+    # lags that would run past the end of the audio sample are skipped and
+    # keep their default value of 0.0
+    valid_lag_count = min(lag_range, len(audio[1]) - (
+        frame_start + first_lag + samples_correlated_per_lag) + 1)
+    if valid_lag_count <= 0:
+        return (candidates, max_correlation_val)
+
+    if params[0].is_two_pass_nccf:
+        additive_constant = 0.0
+    else:
+        additive_constant = float(params[0].additive_constant)
+    correlations, max_val = nccf_kernel(
+        audio[1], frame_start, samples_correlated_per_lag, first_lag,
+        first_lag + valid_lag_count, additive_constant)
 
-        # determine if the current lag value causes us to go past the
-        # end of the audio sample - if so - skip and set val to 0
-        if ((current_lag + (params[1].samples_correlated_per_lag - 1)
-             + (current_frame * params[1].samples_per_frame)) >= len(audio[1])):
-            # candidates[k] = 0.0
-            # TODO: Verify this behavior in unit test - no need to set val
-            # since 0.0 is default
-            continue
+    candidates[:valid_lag_count] = correlations.tolist()
+    max_correlation_val = max(max_correlation_val, max_val)
 
-        candidates[k] = _get_correlation(audio, current_frame,
-                                         current_lag, params)
+    return (candidates, max_correlation_val)
 
-        if candidates[k] > max_correlation_val:
-            max_correlation_val = candidates[k]
 
-    return (candidates, max_correlation_val)
+# number of frames correlated together by the batched numpy NCCF, which keeps
+# its 2-D working arrays small enough to stay in cache on long audio. GPU
+# blocks are bigger, to give each batch of FFTs enough work to be worth it:
+_NCCF_FRAME_BLOCK_SIZE = 256
+_GPU_NCCF_FRAME_BLOCK_SIZE = 4096
+
+
+def _get_frame_block_correlations(audio, first_frame, frame_count, lag_range,
+                                  params, xp=numpy):
+    """
+    Runs NCCF for all lags on frame_count consecutive frames at once and
+    returns the correlations as a (frame, lag) array. Lags that would run
+    past the end of the audio sample are left at 0.0. The work is done with
+    xp, the array module - either numpy or cupy.
+    """
+    samples_correlated_per_lag = params[1].samples_correlated_per_lag
+    samples_per_frame = params[1].samples_per_frame
+    first_lag = params[1].shortest_lag_per_frame
+    lag_audio_len = lag_range + samples_correlated_per_lag - 1
+    window_len = first_lag + lag_audio_len
+
+    # copy the block's samples (zero padded past the end of the audio) so
+    # every frame can be a row of a strided view over them, w/o copying
+    block_start = first_frame * samples_per_frame
+    block_audio = xp.zeros((frame_count - 1) * samples_per_frame + window_len)
+    block_samples = audio[1][block_start:block_start + len(block_audio)]
+    block_audio[:len(block_samples)] = xp.asarray(block_samples)
+    sample_stride = block_audio.strides[0]
+    frames = xp.lib.stride_tricks.as_strided(
+        block_audio, shape=(frame_count, window_len),
+        strides=(samples_per_frame * sample_stride, sample_stride))
+
+    # center each frame's window and lagged samples on the window's mean:
+    means = frames[:, :samples_correlated_per_lag].mean(axis=1)
+    means = means[:, xp.newaxis]
+    base_audio = frames[:, :samples_correlated_per_lag] - means
+    lag_audio = frames[:, first_lag:] - means
+
+    # energy of the window, and running sums of the lagged samples' energy
+    # so each lag's denominator is the difference of two sums:
+    denominator_base = xp.sum(base_audio**2, axis=1)[:, xp.newaxis]
+    lag_energy = xp.concatenate((xp.zeros((frame_count, 1)),
+                                 xp.cumsum(lag_audio**2, axis=1)), axis=1)
+    denominator_lag = (lag_energy[:, samples_correlated_per_lag:] -
+                       lag_energy[:, :lag_range])
+
+    # the numerators for every lag are the cross correlation of each frame's
+    # window with its lagged samples, done for all frames in one FFT pass.
+    # The FFT is long enough that the circular correlation never wraps
+    # around into the lags that are kept:
+    fft_len = 2 ** int(math.ceil(math.log(lag_audio_len, 2)))
+    spectrum = (xp.conj(xp.fft.rfft(base_audio, fft_len, axis=1)) *
+                xp.fft.rfft(lag_audio, fft_len, axis=1))
+    samples = xp.fft.irfft(spectrum, fft_len, axis=1)[:, :lag_range]
+
+    correlations = _get_normalized_correlation(samples, denominator_base,
+                                               denominator_lag, params, True,
+                                               xp)
+
+    frame_starts = ((first_frame + xp.arange(frame_count)) *
+                    samples_per_frame)
+    valid_lag_counts = len(audio[1]) - (frame_starts + first_lag +
+                                        samples_correlated_per_lag) + 1
+    correlations[xp.arange(lag_range)[xp.newaxis, :] >=
+                 valid_lag_counts[:, xp.newaxis]] = 0.0
+    return correlations
+
+
+def _nccf_frame(audio, frame_start, n, k_start, k_end, additive_constant):
+    """
+    Single-loop NCCF kernel for lags k_start to k_end - 1 of one frame, meant
+    to be JIT compiled by numba. Audio must be a contiguous float array, its
+    samples are accumulated in float64.
+    Returns the correlation per lag and the largest of those values.
+    """
+    mean_for_window = 0.0
+    for j in range(n):
+        mean_for_window += audio[frame_start + j]
+    mean_for_window /= n
+
+    denominator_base = 0.0
+    for j in range(n):
+        x = audio[frame_start + j] - mean_for_window
+        denominator_base += x * x
+
+    correlations = numpy.zeros(k_end - k_start)
+    for k in _prange(k_start, k_end):
+        samples = 0.0
+        denominator_lag = 0.0
+        for j in range(n):
+            x = audio[frame_start + j] - mean_for_window
+            y = audio[frame_start + k + j] - mean_for_window
+            samples += x * y
+            denominator_lag += y * y
+        denominator = denominator_base * denominator_lag + additive_constant
+        if denominator > 0.0:
+            correlations[k - k_start] = samples / math.sqrt(denominator)
+
+    max_val = 0.0
+    for k in range(k_end - k_start):
+        if correlations[k] > max_val:
+            max_val = correlations[k]
+    return (correlations, max_val)
+
+
+if numba is not None:
+    _prange = numba.prange
+    # the serial build is for frames that already run in parallel threads
+    # (where prange runs as a plain range). It isn't cached on disk, so its
+    # cache entry can't get mixed up with the parallel build's:
+    _nccf_frame_serial = numba.njit(fastmath=True, nogil=True)(_nccf_frame)
+    _nccf_frame = numba.njit(parallel=True, fastmath=True, cache=True,
+                             nogil=True)(_nccf_frame)
+else:
+    _prange = xrange
 
 
 def _get_correlations_for_input_lags(audio, current_frame, first_pass,
                                      lag_range, params):
     candidates = [0.0] * lag_range
     max_correlation_val = 0.0
-    sorted_firstpass_results = first_pass[current_frame]
-    sorted_firstpass_results.sort(key=lambda tup: tup[0])
-    for lag_val in sorted_firstpass_results:
-        # 1st pass lag value has been interpolated for original audio sample:
-        lag_peak = lag_val[0]
-
-        # for each peak check the closest 7 lags (if proposed peak is ok):
-        if lag_peak > 10 and lag_peak < lag_range - 11:
-            for k in xrange(lag_peak - 10, lag_peak + 11):
-                # determine if the current lag value causes us to go past the
-                # end of the audio sample - if so - skip and set val to 0
-                sample_range = (k + (params[1].samples_correlated_per_lag - 1) +
-                                (current_frame * params[1].samples_per_frame))
-                if sample_range >= len(audio[1]):
-                    # TODO: Verify this behavior in unit test -
-                    # no need to set val
-                    # since 0.0 is default
-                    continue
-                candidates[k] = _get_correlation(audio, current_frame, k,
-                                                 params, False)
-                if candidates[k] > max_correlation_val:
-                    max_correlation_val = candidates[k]
+    frame_window = _get_frame_window(audio, current_frame, params)
+
+    # 1st pass lag values have been interpolated for original audio sample.
+    # For each peak check the closest 21 lags (if proposed peak is ok) -
+    # windows of nearby peaks overlap, so take their union and only
+    # calculate each lag once:
+    lags_to_check = sorted(set(
+        k for lag_val in first_pass[current_frame]
+        if lag_val[0] > 10 and lag_val[0] < lag_range - 11
+        for k in xrange(lag_val[0] - 10, lag_val[0] + 11)))
+
+    # lags from this one on would go past the end of the audio sample, so
+    # they are skipped and keep the default val of 0.0:
+    audio_samples = audio[1]
+    frame_start = current_frame * params[1].samples_per_frame
+    end_of_audio_lag = (len(audio_samples) - frame_start -
+                        (params[1].samples_correlated_per_lag - 1))
+    lags_to_check = [k for k in lags_to_check if k < end_of_audio_lag]
+    if not lags_to_check:
+        return (candidates, max_correlation_val)
+
+    # only the sums are done per lag (w/ lookups hoisted out of the loop),
+    # then all of the frame's lags are normalized in one go:
+    samples = numpy.empty(len(lags_to_check))
+    denominator_lag = numpy.empty(len(lags_to_check))
+    for i, k in enumerate(lags_to_check):
+        samples[i], denominator_lag[i] = _get_lag_sums(audio_samples,
+                                                       frame_start + k,
+                                                       frame_window)
+    correlations = _get_normalized_correlation(samples, frame_window[2],
+                                               denominator_lag, params,
+                                               False).tolist()
+    for k, correlation in zip(lags_to_check, correlations):
+        candidates[k] = correlation
+    max_correlation_val = max(max_correlation_val, max(correlations))
 
     return (candidates, max_correlation_val)
 
@@ -379,15 +675,17 @@ def _get_marked_results(lag_results, params, is_firstpass=True):
         candidates = _extrapolate_lag_val(lag_results, min_valid_correlation,
                                           max_allowed_candidates, params)
     else:
+        shortest_lag = params[1].shortest_lag_per_frame
         for k, k_val in enumerate(lag_results[0]):
             if k_val > min_valid_correlation:
-                current_lag = k + params[1].shortest_lag_per_frame
-                candidates.append((current_lag, k_val))
+                candidates.append((k + shortest_lag, k_val))
 
     # now check to see if selected candidates exceed max allowed:
     if len(candidates) > max_allowed_candidates:
-        candidates.sort(key=lambda tup: tup[1], reverse=True)
-        returned_candidates = candidates[0:max_allowed_candidates]
+        # only the top correlations are kept, so no need to sort all of them
+        returned_candidates = heapq.nlargest(max_allowed_candidates,
+                                             candidates,
+                                             key=lambda tup: tup[1])
         # re-sort before returning so that it is in order of low to highest k
         returned_candidates.sort(key=lambda tup: tup[0])
     else:
@@ -396,35 +694,81 @@ def _get_marked_results(lag_results, params, is_firstpass=True):
     return returned_candidates
 
 
-def _get_correlation(audio, frame, lag, params, is_firstpass=True):
-    numpysum = numpy.sum
-    samples = 0
-    audio_sample = audio[1]
+def _get_frame_window(audio, frame, params):
+    """
+    Returns the mean of the "n" samples starting at the given frame, along
+    with those samples centered on that mean and their summed energy.
+    """
     samples_correlated_per_lag = params[1].samples_correlated_per_lag
     frame_start = frame * params[1].samples_per_frame
     final_correlated_sample = frame_start + samples_correlated_per_lag
 
-    frame_sum = numpysum(audio_sample[frame_start:final_correlated_sample])
-    mean_for_window = ((1.0 / float(samples_correlated_per_lag)) * frame_sum)
-
-    audio_slice = audio_sample[frame_start:final_correlated_sample]
-    lag_audio_slice = audio_sample[frame_start + lag:
-                                   final_correlated_sample + lag]
-
-    samples = numpysum((audio_slice - mean_for_window) *
-                       (lag_audio_slice - mean_for_window))
-
-    denominator_base = numpysum((audio_slice - float(mean_for_window))**2)
-    denominator_lag = numpysum((lag_audio_slice - float(mean_for_window))**2)
-
-    if is_firstpass and params[0].is_two_pass_nccf:
-        denominator = math.sqrt(denominator_base * denominator_lag)
+    audio_slice = audio[1][frame_start:final_correlated_sample]
+    cumulative_sum = params[1].cumulative_audio_sum
+    if cumulative_sum is not None:
+        final_sum_idx = min(final_correlated_sample, len(cumulative_sum) - 1)
+        frame_sum = cumulative_sum[final_sum_idx] - cumulative_sum[frame_start]
     else:
-        denominator = ((denominator_base * denominator_lag) +
-                       params[0].additive_constant)
-        denominator = math.sqrt(denominator)
+        frame_sum = numpy.sum(audio_slice, dtype=numpy.float64)
+    mean_for_window = frame_sum / float(samples_correlated_per_lag)
+    # float32 samples are promoted as they're centered, so the dot products
+    # below accumulate in float64:
+    centered_slice = numpy.subtract(audio_slice, mean_for_window,
+                                    dtype=numpy.float64)
+    denominator_base = numpy.dot(centered_slice, centered_slice)
+    return (mean_for_window, centered_slice, denominator_base)
+
+
+def _get_correlation(audio, frame, lag, params, is_firstpass=True,
+                     frame_window=None):
+    # frame_window can be passed in by callers that correlate the same frame
+    # against many lags so the frame's samples aren't re-centered each time
+    if frame_window is None:
+        frame_window = _get_frame_window(audio, frame, params)
+    lag_start = frame * params[1].samples_per_frame + lag
+    samples, denominator_lag = _get_lag_sums(audio[1], lag_start,
+                                             frame_window)
+
+    return float(_get_normalized_correlation(samples, frame_window[2],
+                                             denominator_lag, params,
+                                             is_firstpass))
+
+
+def _get_lag_sums(audio_samples, lag_start, frame_window):
+    # returns the NCCF numerator and the lag energy for the samples starting
+    # at lag_start, correlated against the frame's window
+    mean_for_window, audio_slice = frame_window[0], frame_window[1]
+    if _nccf is not None and audio_samples.dtype in _NCCF_KERNEL_DTYPES:
+        # one fused pass over the lagged samples, w/o temporary arrays
+        return _nccf.lag_sums(audio_samples, lag_start, audio_slice,
+                              mean_for_window)
+
+    lag_audio_slice = numpy.subtract(
+        audio_samples[lag_start:lag_start + len(audio_slice)],
+        mean_for_window, dtype=numpy.float64)
+    return (numpy.dot(audio_slice, lag_audio_slice),
+            numpy.dot(lag_audio_slice, lag_audio_slice))
+
+
+def _get_normalized_correlation(samples, denominator_base, denominator_lag,
+                                params, is_firstpass=True, xp=numpy):
+    """
+    Divides the NCCF numerator by the root of the two window energies (plus
+    the additive constant unless this is the 1st pass of a 2-pass run).
+    Numerators and lag energies may also be (numpy or cupy) arrays covering
+    many lags.
+    """
+    # energy obtained from differences of running sums can come out a hair
+    # below zero for silent stretches, so clamp it before taking the root:
+    denominator = xp.maximum(denominator_base * denominator_lag, 0.0)
+    if not (is_firstpass and params[0].is_two_pass_nccf):
+        denominator = denominator + params[0].additive_constant
+    denominator = xp.sqrt(denominator)
 
-    return float(samples) / float(denominator)
+    # a window of digital silence has no energy - treat it as uncorrelated
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        correlation = xp.true_divide(samples, denominator)
+    return xp.where(denominator > 0.0, correlation, 0.0)
 
 
 def _extrapolate_lag_val(lag_results, min_valid_correlation,
@@ -439,77 +783,61 @@ def _extrapolate_lag_val(lag_results, min_valid_correlation,
         extrapolated_cands.append((new_lag, lag_results[0][0]))
         return extrapolated_cands
 
-    least_lag = params[0].sample_rate_ratio * params[1].shortest_lag_per_frame
-    most_lag = params[0].sample_rate_ratio * params[1].longest_lag_per_frame
-    for k, k_val in enumerate(lag_results[0]):
+    # params are looked up once here, rather than for every lag below:
+    sample_rate_ratio = params[0].sample_rate_ratio
+    shortest_lag = params[1].shortest_lag_per_frame
+    correlations = lag_results[0]
+    least_lag = sample_rate_ratio * shortest_lag
+    most_lag = sample_rate_ratio * params[1].longest_lag_per_frame
+    last_k = len(correlations) - 1
+    for k, k_val in enumerate(correlations):
         if k_val > min_valid_correlation:
-            current_lag = k + params[1].shortest_lag_per_frame
-            new_lag = int(round(current_lag * params[0].sample_rate_ratio))
-            if k == 0:
-                # if at 1st lag value, interpolate using 0,0 input on left
-                prev_lag = k - 1 + params[1].shortest_lag_per_frame
-                new_prev = int(round(prev_lag * params[0].sample_rate_ratio))
-                next_lag = (k + 1 + params[1].shortest_lag_per_frame)
-                new_next = int(round(next_lag * params[0].sample_rate_ratio))
-                lags = numpy.array([new_prev, new_lag, new_next])
-                vals = numpy.array([0.0, k_val, lag_results[0][k+1]])
-                para = numpy.polyfit(lags, vals, 2)
-                final_lag = int(round(-para[1] / (2 * para[0])))
-                final_corr = float(para[0] * final_lag**2 + para[1] *
-                                   final_lag + para[2])
-                if (final_lag < least_lag or final_lag > most_lag or
-                        final_corr < -1.0 or final_corr > 1.0):
-                    current_lag = k + params[1].shortest_lag_per_frame
-                    new_lag = int(round(current_lag *
-                                        params[0].sample_rate_ratio))
-                    extrapolated_cands.append((new_lag, k_val))
-                else:
-                    extrapolated_cands.append((final_lag, final_corr))
-            elif k == len(lag_results[0]) - 1:
-                # if at last lag value, interpolate using 0,0 input on right
-                next_lag = k + 1 + params[1].shortest_lag_per_frame
-                new_next = int(round(next_lag * params[0].sample_rate_ratio))
-                prev_lag = (k - 1 + params[1].shortest_lag_per_frame)
-                new_prev = int(round(prev_lag * params[0].sample_rate_ratio))
-                lags = numpy.array([new_prev, new_lag, new_next])
-                vals = numpy.array([lag_results[0][k-1], k_val, 0.0])
-                para = numpy.polyfit(lags, vals, 2)
-                final_lag = int(round(-para[1] / (2 * para[0])))
-                final_corr = float(para[0] * final_lag**2 + para[1] *
-                                   final_lag + para[2])
-                if (final_lag < least_lag or final_lag > most_lag or
-                        final_corr < -1.0 or final_corr > 1.0):
-                    current_lag = k + params[1].shortest_lag_per_frame
-                    new_lag = int(round(current_lag *
-                                        params[0].sample_rate_ratio))
-                    extrapolated_cands.append((new_lag, k_val))
-                else:
-                    extrapolated_cands.append((final_lag, final_corr))
+            current_lag = k + shortest_lag
+            new_lag = int(round(current_lag * sample_rate_ratio))
+            prev_lag = k - 1 + shortest_lag
+            new_prev = int(round(prev_lag * sample_rate_ratio))
+            next_lag = k + 1 + shortest_lag
+            new_next = int(round(next_lag * sample_rate_ratio))
+            # at the 1st or last lag value, interpolate using a 0.0
+            # correlation on the side that falls outside the lag results:
+            prev_val = correlations[k-1] if k > 0 else 0.0
+            next_val = correlations[k+1] if k < last_k else 0.0
+            peak = _get_parabolic_peak((new_prev, new_lag, new_next),
+                                       (prev_val, k_val, next_val))
+            if (peak is None or peak[0] < least_lag or peak[0] > most_lag or
+                    peak[1] < -1.0 or peak[1] > 1.0):
+                extrapolated_cands.append((new_lag, k_val))
             else:
-                # we are in middle of lag results - use left and right
-                next_lag = (k + 1 + params[1].shortest_lag_per_frame)
-                new_next = int(round(next_lag * params[0].sample_rate_ratio))
-                prev_lag = (k - 1 + params[1].shortest_lag_per_frame)
-                new_prev = int(round(prev_lag * params[0].sample_rate_ratio))
-                lags = numpy.array([new_prev, new_lag, new_next])
-                vals = numpy.array([lag_results[0][k-1], k_val,
-                                   lag_results[0][k+1]])
-                para = numpy.polyfit(lags, vals, 2)
-                final_lag = int(round(-para[1] / (2 * para[0])))
-                final_corr = float(para[0] * final_lag**2 + para[1] *
-                                   final_lag + para[2])
-                if (final_lag < least_lag or final_lag > most_lag or
-                        final_corr < -1.0 or final_corr > 1.0):
-                    current_lag = k + params[1].shortest_lag_per_frame
-                    new_lag = int(round(current_lag *
-                                        params[0].sample_rate_ratio))
-                    extrapolated_cands.append((new_lag, k_val))
-                else:
-                    extrapolated_cands.append((final_lag, final_corr))
+                extrapolated_cands.append(peak)
 
     return extrapolated_cands
 
 
+def _get_parabolic_peak(lags, vals):
+    """
+    Fits a parabola exactly through three (lag, correlation) points and
+    returns the lag nearest its vertex along with the parabola's value at
+    that lag. Returns None if the points don't define a parabola.
+    """
+    # work relative to the middle lag, so the parabola is a*t^2 + b*t + c
+    # with c being the middle correlation value
+    prev_offset = lags[0] - lags[1]
+    next_offset = lags[2] - lags[1]
+    prev_rise = vals[0] - vals[1]
+    next_rise = vals[2] - vals[1]
+    determinant = float(prev_offset * next_offset * (prev_offset - next_offset))
+    if determinant == 0.0:
+        return None
+    a = (prev_rise * next_offset - next_rise * prev_offset) / determinant
+    b = (next_rise * prev_offset**2 - prev_rise * next_offset**2) / determinant
+    if a == 0.0:
+        return None
+    final_lag = int(round(lags[1] - b / (2 * a)))
+    offset = final_lag - lags[1]
+    final_corr = float(a * offset**2 + b * offset + vals[1])
+    return (final_lag, final_corr)
+
+
 # TODO: Try and get peaks instead of just taking the basic lag value, but
 # don't introduce wildly different lag values.
 def _get_peak_lag_val(lag_results, lag_index, params):
@@ -555,164 +883,199 @@ def _get_freq_estimate(nccf_results, raptparam, sample_rate):
     return results
 
 
-# this method will prepare to call a recursive function that will determine
+# this method will run the dynamic programming over every frame to determine
 # the optimal voicing state / candidate per frame
 def _determine_state_per_frame(nccf_results, raptparam, sample_rate):
-    candidates = []
     # Add unvoiced candidate entry per frame (tuple w/ 0 lag, 0 correlation)
     for result in nccf_results:
         result.append((0, 0.0))
+    if not nccf_results:
+        return []
 
-    # now call recursive function that will calculate cost per candidate:
-    final_candidates = _select_candidates(nccf_results, raptparam, sample_rate)
-    # sort results - take the result with the lowest cost for its last item
-    final_candidates.sort(key=lambda y: y[-1][0])
+    # pack the candidates into padded (frame, candidate) arrays, so the DP
+    # works on a frame's candidates at once rather than tuple by tuple:
+    trellis = _get_candidate_trellis(nccf_results)
+
+    # forward pass calculates the best cost per candidate along with a
+    # pointer to the candidate in the previous frame that it came from:
+    final_costs, frame_pointers = _process_candidates(trellis, raptparam,
+                                                      sample_rate)
 
     # with the results, take the lag of the lowest cost candidate per frame
-    for result in final_candidates[0]:
-        # sort results - the first value, the cost, is used by default
-        candidates.append(result[1][0])
-    return candidates
+    return _get_best_path(trellis, final_costs, frame_pointers)
 
 
-def _select_candidates(nccf_results, params, sample_rate):
-    # start by calculating frame 0:
-    max_for_frame = _select_max_correlation_for_frame(nccf_results[0])
-    frame_candidates = []
-    for candidate in nccf_results[0]:
-        best_cost = None
-        local_cost = _calculate_local_cost(candidate, max_for_frame, params,
-                                           sample_rate)
-        for initial_candidate in [(0.0, (1, 0.1)), (0.0, (0, 0.0))]:
-            delta_cost = _get_delta_cost(candidate, initial_candidate,
-                                         0, params)
-            total_cost = local_cost + delta_cost
-            if best_cost is None or total_cost <= best_cost:
-                best_cost = total_cost
-        frame_candidates.append([(best_cost, candidate)])
-    # now we have initial costs for frame 0. lets loop thru later frames
-    final_candidates = _get_next_cands(1, frame_candidates, nccf_results,
-                                       params, sample_rate)
-    return final_candidates
-
-
-def _get_next_cands(frame_idx, prev_candidates, nccf_results, params,
-                    sample_rate):
-    frame_max = _select_max_correlation_for_frame(nccf_results[frame_idx])
-    final_candidates = []
-    for candidate in nccf_results[frame_idx]:
-        best_cost = None
-        returned_path = None
-        local_cost = _calculate_local_cost(candidate, frame_max, params,
-                                           sample_rate)
-        for prev_candidate in prev_candidates:
-            delta_cost = _get_delta_cost(candidate, prev_candidate[-1],
-                                         frame_idx, params)
-            total_cost = local_cost + delta_cost
-            if best_cost is None or total_cost <= best_cost:
-                best_cost = total_cost
-                returned_path = list(prev_candidate)
-        returned_path.append((best_cost, candidate))
-        final_candidates.append(returned_path)
-    next_idx = frame_idx + 1
-    if next_idx < len(nccf_results):
-        return _get_next_cands(next_idx, final_candidates, nccf_results,
-                               params, sample_rate)
-    return final_candidates
-
-
-def _select_max_correlation_for_frame(nccf_results_frame):
-    maxval = 0.0
-    for hypothesis in nccf_results_frame:
-        if hypothesis[1] > maxval:
-            maxval = hypothesis[1]
-    return maxval
+def _get_candidate_trellis(nccf_results):
+    """
+    Packs the (lag, correlation) candidates of every frame into arrays of
+    shape (frame, candidate), padded out to the frame with the most
+    candidates. Returns the lags (-1 for padding), correlations, log of the
+    lags (0.0 for unvoiced and padding), whether each candidate is voiced,
+    and a mask of the slots that hold actual candidates.
+    """
+    candidate_counts = numpy.array([len(result) for result in nccf_results])
+    mask = (numpy.arange(candidate_counts.max())[numpy.newaxis, :] <
+            candidate_counts[:, numpy.newaxis])
+
+    # candidates fill each frame's row from the left, in their original
+    # order, so ties in the DP are broken the same way as before padding:
+    all_candidates = numpy.array([candidate for result in nccf_results
+                                  for candidate in result], dtype=float)
+    lags = numpy.full(mask.shape, -1, dtype=int)
+    lags[mask] = all_candidates[:, 0]
+    corrs = numpy.zeros(mask.shape)
+    corrs[mask] = all_candidates[:, 1]
+
+    is_voiced = mask & ~_is_unvoiced((lags, corrs))
+    # keep the log of each lag so it is computed once, rather than for every
+    # pair of candidates in neighboring frames:
+    log_lags = numpy.zeros(mask.shape)
+    log_lags[lags > 0] = numpy.log(lags[lags > 0])
+    return (lags, corrs, log_lags, is_voiced, mask)
+
+
+def _process_candidates(trellis, params, sample_rate):
+    lags, corrs, log_lags, is_voiced, mask = trellis
+    local_costs = _get_local_costs(trellis, params, sample_rate)
+
+    # frame 0 is compared against both a voiced and an unvoiced starting point
+    prev_costs = numpy.zeros(2)
+    prev_candidates = (numpy.zeros(2), numpy.array([True, False]))
+    frame_pointers = numpy.zeros(lags.shape, dtype=int)
+    for frame_idx in xrange(0, len(lags)):
+        candidates = (log_lags[frame_idx], is_voiced[frame_idx])
+        delta_costs = _get_delta_costs(candidates, prev_candidates, frame_idx,
+                                       params)
+        prev_costs, frame_pointers[frame_idx] = _calculate_costs_per_frame(
+            prev_costs, delta_costs, local_costs[frame_idx])
+        prev_candidates = candidates
+    return (prev_costs, frame_pointers)
+
+
+def _calculate_costs_per_frame(prev_costs, delta_costs, local_costs):
+    # returns the best cost for each candidate and the index of the previous
+    # frame's candidate that it is reached from.
+    # rows are this frame's candidates, columns the previous frame's:
+    total_costs = prev_costs[numpy.newaxis, :] + delta_costs
+    # searching the columns in reverse keeps the last of equally cheap
+    # previous candidates as the best one
+    last_idx = total_costs.shape[1] - 1
+    best_pointers = last_idx - total_costs[:, ::-1].argmin(axis=1)
+    best_costs = local_costs + total_costs[numpy.arange(len(local_costs)),
+                                           best_pointers]
+    return (best_costs, best_pointers)
+
+
+def _get_best_path(trellis, final_costs, frame_pointers):
+    # backtrace from the lowest cost candidate in the final frame, following
+    # the pointers to each frame's best previous candidate
+    lags = [0] * len(frame_pointers)
+    if not len(frame_pointers):
+        return lags
+    best_idx = numpy.argmin(final_costs)
+    for frame_idx in reversed(xrange(0, len(frame_pointers))):
+        lags[frame_idx] = int(trellis[0][frame_idx][best_idx])
+        best_idx = frame_pointers[frame_idx][best_idx]
+    return lags
+
+
+def _get_local_costs(trellis, params, sample_rate):
+    # local cost of every candidate in every frame - padding slots are given
+    # an infinite cost so the DP never picks them
+    lags, corrs, log_lags, is_voiced, mask = trellis
+    max_corr_per_frame = numpy.maximum(corrs.max(axis=1), 0.0)
+    local_costs = _calculate_local_cost((lags, corrs),
+                                        max_corr_per_frame[:, numpy.newaxis],
+                                        params, sample_rate)
+    return numpy.where(mask, local_costs, numpy.inf)
 
 
 def _calculate_local_cost(candidate, max_corr_for_frame, params, sample_rate):
-    # calculate local cost of hypothesis (d_i,j in RAPT)
+    # calculate local cost of hypothesis (d_i,j in RAPT), works elementwise
+    # on arrays of lags and correlation vals
     lag_val = candidate[0]
     correlation_val = candidate[1]
-    if lag_val == 0 and correlation_val == 0.0:
-        # unvoiced hypothesis: add VO_BIAS to largest correlation val in frame
-        cost = params.voicing_bias + max_corr_for_frame
-    else:
-        # voiced hypothesis
-        lag_weight = (float(params.lag_weight) / float(sample_rate /
-                      float(params.minimum_allowed_freq)))
-        cost = (1.0 - correlation_val * (1.0 - float(lag_weight)
-                * float(lag_val)))
-    return cost
-
-
-# determine what type of transition for candidate and previous, and return delta
-def _get_delta_cost(candidate, prev_candidate, frame_idx, params):
-    # determine what type of transition:
-    if _is_unvoiced(candidate) and _is_unvoiced(prev_candidate[1]):
-        return _get_unvoiced_to_unvoiced_cost(prev_candidate)
-    elif _is_unvoiced(candidate):
-        return _get_voiced_to_unvoiced_cost(candidate, prev_candidate,
-                                            frame_idx, params)
-    elif _is_unvoiced(prev_candidate[1]):
-        return _get_unvoiced_to_voiced_cost(candidate, prev_candidate,
-                                            frame_idx, params)
-    else:
-        return _get_voiced_to_voiced_cost(candidate, prev_candidate, params)
+    # voiced hypothesis
+    lag_weight = (float(params.lag_weight) / float(sample_rate /
+                  float(params.minimum_allowed_freq)))
+    voiced_cost = (1.0 - correlation_val * (1.0 - float(lag_weight)
+                   * lag_val))
+    # unvoiced hypothesis: add VO_BIAS to largest correlation val in frame
+    unvoiced_cost = params.voicing_bias + max_corr_for_frame
+    return numpy.where(_is_unvoiced(candidate), unvoiced_cost, voiced_cost)
+
+
+# determine the delta cost between each candidate (rows) and each candidate
+# of the previous frame (columns) based on the type of transition:
+def _get_delta_costs(candidates, prev_candidates, frame_idx, params):
+    # candidates are given as arrays of their log lags and voicing states
+    log_lags, is_voiced = candidates
+    prev_log_lags, prev_is_voiced = prev_candidates
+    is_voiced = is_voiced[:, numpy.newaxis]
+    prev_is_voiced = prev_is_voiced[numpy.newaxis, :]
+
+    delta = _get_voiced_to_voiced_cost(log_lags[:, numpy.newaxis],
+                                       prev_log_lags[numpy.newaxis, :],
+                                       params)
+    # rms ratio only depends on the frame, so get it once for all pairs - and
+    # only when there is a voicing transition, since it is undefined for
+    # frames of digital silence (where only the unvoiced hypothesis exists):
+    if (is_voiced != prev_is_voiced).any():
+        rms_ratio = _get_rms_ratio(frame_idx, params)
+        delta = numpy.where(~is_voiced & prev_is_voiced,
+                            _get_voiced_to_unvoiced_cost(rms_ratio, params),
+                            delta)
+        delta = numpy.where(is_voiced & ~prev_is_voiced,
+                            _get_unvoiced_to_voiced_cost(rms_ratio, params),
+                            delta)
+    # delta cost of unvoiced to unvoiced is 0:
+    delta = numpy.where(~is_voiced & ~prev_is_voiced, 0.0, delta)
+    return delta
 
 
 # for a candidate tuple w/ lag and correlation value, determine if it is a
-# placeholder for unvoiced hypothesis
+# placeholder for unvoiced hypothesis (works elementwise on arrays too)
 def _is_unvoiced(candidate):
-    return candidate[0] == 0 and candidate[1] == 0.0
+    return numpy.logical_and(candidate[0] == 0, candidate[1] == 0.0)
 
 
-# determines cost of voiced to voice delta w/ prev entry's global cost:
-def _get_voiced_to_voiced_cost(candidate, prev_entry, params):
-    numpylog = numpy.log
-    prev_cost = prev_entry[0]
-    prev_candidate = prev_entry[1]
-    # value of epsilon in voiced-to-voiced delta formula:
-    freq_jump_cost = numpylog(float(candidate[0]) / float(prev_candidate[0]))
-    transition_cost = (params.freq_weight * (params.doubling_cost +
-                       abs(freq_jump_cost - numpylog(2.0))))
-    final_cost = prev_cost + transition_cost
-    return final_cost
+# natural log of 2, used for the octave jump in voiced transition costs
+_LOG_OF_2 = math.log(2.0)
 
 
-# delta cost of unvoiced to unvoiced is 0, so just return previous entry's
-# global cost:
-def _get_unvoiced_to_unvoiced_cost(prev_entry):
-    return prev_entry[0] + 0.0
+# determines cost of voiced to voice delta given the candidates' log lags
+# (works elementwise on arrays of log lags):
+def _get_voiced_to_voiced_cost(log_lag, prev_log_lag, params):
+    # value of epsilon in voiced-to-voiced delta formula, the log of the ratio
+    # of the two lags:
+    freq_jump_cost = log_lag - prev_log_lag
+    transition_cost = (params.freq_weight * (params.doubling_cost +
+                       abs(freq_jump_cost - _LOG_OF_2)))
+    return transition_cost
 
 
-def _get_voiced_to_unvoiced_cost(candidate, prev_entry, frame_idx, params):
-    prev_cost = prev_entry[0]
-    # prev_candidate = prev_entry[1]
+def _get_voiced_to_unvoiced_cost(rms_ratio, params):
     # NOTE: Not using spec_mod / itakura distortion for delta cost
     # delta = (params.transition_cost + (params.spec_mod_transition_cost *
     #         _get_spec_stationarity()) + (params.amp_mod_transition_cost *
     #         _get_rms_ratio(sample_rate)))
     delta = (params.transition_cost + (params.amp_mod_transition_cost *
-             _get_rms_ratio(frame_idx, params)))
-    return prev_cost + delta
+             rms_ratio))
+    return delta
 
 
-def _get_unvoiced_to_voiced_cost(candidate, prev_entry, frame_idx, params):
-    prev_cost = prev_entry[0]
-    # prev_candidate = prev_entry[1]
+def _get_unvoiced_to_voiced_cost(rms_ratio, params):
     # NOTE: Not using spec_mod / itakura distortion for delta cost
     # delta = (params.transition_cost + (params.spec_mod_transition_cost *
     #         _get_spec_stationarity()) + (params.amp_mod_transition_cost /
     #         _get_rms_ratio(sample_rate)))
-    current_rms_ratio = _get_rms_ratio(frame_idx, params)
-
     # TODO: figure out how to better handle rms ratio on final frame
-    if current_rms_ratio <= 0:
-        return prev_cost + params.transition_cost
+    if rms_ratio <= 0:
+        return params.transition_cost
 
     delta = (params.transition_cost + (params.amp_mod_transition_cost /
-             current_rms_ratio))
-    return prev_cost + delta
+             rms_ratio))
+    return delta
 
 
 # NOTE: this method is not being utilized for transition costs
@@ -762,8 +1125,10 @@ def _get_rms_ratio(frame_idx, params):
     # the hanning window vals match up with our slice of the audio sample
     hanning_win_val = hanning_win_vals[:hanning_win_len]
 
-    curr_sum = numpy.sum((audio_slice * hanning_win_val)**2)
-    prev_sum = numpy.sum((prev_audio_slice * hanning_win_val)**2)
+    curr_windowed = audio_slice * hanning_win_val
+    prev_windowed = prev_audio_slice * hanning_win_val
+    curr_sum = numpy.dot(curr_windowed, curr_windowed)
+    prev_sum = numpy.dot(prev_windowed, prev_windowed)
 
     # TODO: Do a better job of handling the case where we are at the end
     # of the audio sample and the last frame has no samples to analyze for ratio
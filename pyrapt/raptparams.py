@@ -15,6 +15,21 @@ class Raptparams:
         # Boolean flag to run a low pass filter on the 1st pass of NCCF:
         self.is_run_filter = True
 
+        # Boolean flag to downsample with polyphase filtering instead of FFT:
+        self.is_polyphase_resample = True
+
+        # Number of threads used to run NCCF frames in parallel (when joblib
+        # is installed). -1 uses one thread per CPU, 1 disables threading:
+        self.n_jobs = -1
+
+        # Backend for the all-lags NCCF - 'auto', 'cupy', 'numba', 'cython' or
+        # 'numpy'. 'auto' runs on the GPU (via cupy, if a CUDA device is
+        # visible) for audio of at least gpu_min_sample_count samples,
+        # otherwise the first installed of numba, the Cython kernel, then
+        # numpy:
+        self.nccf_backend = 'auto'
+        self.gpu_min_sample_count = 1000000
+
         # Value of "F0_max" in NCCF equation:
         self.maximum_allowed_freq = 500
 
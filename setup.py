@@ -1,6 +1,17 @@
 import setuptools
 from pyrapt.version import Version
 
+# The Cython NCCF kernel is optional - without Cython pyrapt uses its numba or
+# numpy implementations instead
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize([setuptools.Extension(
+        'pyrapt._nccf', ['pyrapt/_nccf.pyx'],
+        extra_compile_args=['-O3', '-march=native', '-ffast-math',
+                            '-funroll-loops'])])
+except ImportError:
+    ext_modules = []
+
 setuptools.setup(name='pyrapt',
     version=Version('0.0.1').number,
     description='PyRapt - Python implementation of RAPT (Robust Algorithm for Pitch Tracking)',
@@ -9,6 +20,7 @@ setuptools.setup(name='pyrapt',
     author_email='daniel.gaspari@gmail.com',
     url='https://github.com/dgaspari/pyrapt',
     py_modules=['pyrapt'],
+    ext_modules=ext_modules,
     install_requires=[],
     license='MIT License',
     zip_safe=False,
@@ -2,8 +2,10 @@
 Unit tests for methods used during NCCF calculations
 """
 from unittest import TestCase
+from unittest import skipIf
 from mock import patch
 from mock import ANY
+from mock import MagicMock
 
 import numpy
 
@@ -44,20 +46,24 @@ class TestNccfMethods(TestCase):
         self.assertEqual(5, first_params.longest_lag_per_frame)
         self.assertEqual(20, first_params.samples_per_frame)
         self.assertEqual(2, first_params.max_frame_count)
+        # only the 2nd pass needs the running sum of the audio:
+        self.assertIsNone(first_params.cumulative_audio_sum)
         second_params = pyrapt._get_nccf_params(audio_input, params, False)
         self.assertEqual(0, second_params.shortest_lag_per_frame)
         self.assertEqual(5, second_params.longest_lag_per_frame)
         self.assertEqual(20, second_params.samples_correlated_per_lag)
         self.assertEqual(2, second_params.max_frame_count)
+        self.assertEqual(61, len(second_params.cumulative_audio_sum))
 
-    @patch('pyrapt.pyrapt._get_firstpass_frame_results')
-    def test_nccf_firstpass(self, mock_frame_results):
-        mock_frame_results.return_value = [(8, 0.7), (12, 0.8), (21, 0.6)]
+    @patch('pyrapt.pyrapt._get_marked_results')
+    def test_nccf_firstpass(self, mock_marked_results):
+        mock_marked_results.return_value = [(8, 0.7), (12, 0.8), (21, 0.6)]
         # TODO: This is with default params. Do it with passed in ones as well
         sample_rate = 2004
         audio_data = numpy.full(3346, 5.0)
         params = raptparams.Raptparams()
         candidates = pyrapt._first_pass_nccf((sample_rate, audio_data), params)
+        mock_marked_results.assert_called_with(ANY, ANY, True)
         self.assertEqual(166, len(candidates))
         self.assertEqual(3, len(candidates[0]))
         self.assertEqual(0.8, candidates[34][1][1])
@@ -66,7 +72,7 @@ class TestNccfMethods(TestCase):
     def test_nccf_secondpass(self, mock_frame_results):
         mock_frame_results.return_value = [(5, 0.6), (30, 0.7), (55, 0.9)]
         first_pass = [(4, 0.6)] * 165
-        audio_data = (44100, numpy.full(73612, 6.8))
+        audio_data = (44100, numpy.full(73612, 6.8, dtype=numpy.float32))
         raptparam = raptparams.Raptparams()
         raptparam.sample_rate_ratio = 20
         with patch('pyrapt.pyrapt._get_nccf_params') as mock_get_params:
@@ -87,19 +93,36 @@ class TestNccfMethods(TestCase):
             self.assertEqual(165, len(candidates))
             self.assertEqual(5, candidates[0][0][0])
 
-    @patch('pyrapt.pyrapt._get_correlations_for_all_lags')
-    def test_get_results_for_frame(self, mock_get_for_all_lags):
-        mock_get_for_all_lags.return_value = ([0.2] * 35, 0.3)
+    def test_get_results_per_frame(self):
         audio = (2004, numpy.full(3346, 5.0))
+        for n_jobs in [1, 4]:
+            results = pyrapt._get_results_per_frame(
+                lambda a, i, x: (i, x), audio, 25, n_jobs, 'extra')
+            self.assertEqual(25, len(results))
+            self.assertEqual((0, 'extra'), results[0])
+            self.assertEqual((24, 'extra'), results[24])
+
+    def test_get_correlations_for_all_frames(self):
+        audio = (2004, numpy.sin(numpy.arange(3346) * 0.3) * 100.0)
         params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_correlated_per_lag = 20
+        params[1].samples_per_frame = 20
+        params[1].shortest_lag_per_frame = 10
+        # frames past the first block, with the last running off the audio:
+        params[1].max_frame_count = 300
         lag_range = 8
-        with patch('pyrapt.pyrapt._get_marked_results') as mock_mark:
-            mock_mark.return_value = [(9, 0.7), (15, 0.8), (17, 0.6)]
-            results = pyrapt._get_firstpass_frame_results(audio, 5, lag_range,
+        results = pyrapt._get_correlations_for_all_frames(audio, lag_range,
                                                           params)
-            mock_mark.assert_called_once_with(ANY, ANY, True)
-            self.assertEqual(3, len(results))
-            self.assertEqual(0.8, results[1][1])
+        self.assertEqual(300, len(results))
+        for i in [0, 5, 256, 299]:
+            for k in xrange(0, lag_range):
+                if i * 20 + 10 + k + 20 <= 3346:
+                    expected = pyrapt._get_correlation(audio, i, k + 10,
+                                                       params)
+                else:
+                    expected = 0.0
+                self.assertAlmostEqual(expected, results[i][0][k])
+            self.assertEqual(max(0.0, max(results[i][0])), results[i][1])
 
     @patch('pyrapt.pyrapt._get_correlations_for_input_lags')
     def test_get_second_pass_results_for_frame(self, mock_get_correlations):
@@ -122,11 +145,8 @@ class TestNccfMethods(TestCase):
             mock_res.assert_called_once_with(mock_return_val, params, False)
             self.assertEqual(4, frame_results[0][0])
 
-    # TODO: test logic where we avoid lags that exceed sample array len
-    @patch('pyrapt.pyrapt._get_correlation')
-    def test_get_correlations_for_all_lags(self, mock_get_correlation):
-        mock_get_correlation.return_value = 0.4
-        audio = (2004, numpy.full(3346, 5.0))
+    def test_get_correlations_for_all_lags(self):
+        audio = (2004, numpy.sin(numpy.arange(3346) * 0.3) * 100.0)
         params = (raptparams.Raptparams(), nccfparams.Nccfparams())
         params[1].samples_correlated_per_lag = 20
         params[1].samples_per_frame = 20
@@ -134,17 +154,143 @@ class TestNccfMethods(TestCase):
         lag_range = 8
         results = pyrapt._get_correlations_for_all_lags(audio, 5,
                                                         lag_range, params)
-        self.assertEqual(0.4, results[1])
         self.assertEqual(8, len(results[0]))
-        self.assertEqual(0.4, results[0][7])
-        mock_get_correlation.assert_called_with(ANY, ANY, ANY, ANY)
+        # running sum denominators should match the direct calculation:
+        for k in xrange(0, lag_range):
+            expected = pyrapt._get_correlation(audio, 5, k + 10, params)
+            self.assertAlmostEqual(expected, results[0][k])
+        self.assertEqual(max(results[0]), results[1])
+
+    def test_get_correlations_for_all_lags_past_audio_end(self):
+        audio = (2004, numpy.sin(numpy.arange(135) * 0.3) * 100.0)
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_correlated_per_lag = 20
+        params[1].samples_per_frame = 20
+        params[1].shortest_lag_per_frame = 10
+        lag_range = 8
+        # frame 5 starts at sample 100, so only lags 10 - 15 fit in audio:
+        results = pyrapt._get_correlations_for_all_lags(audio, 5,
+                                                        lag_range, params)
+        self.assertEqual(8, len(results[0]))
+        self.assertNotEqual(0.0, results[0][5])
+        self.assertEqual(0.0, results[0][6])
+        self.assertEqual(0.0, results[0][7])
+
+    def test_get_correlations_for_all_lags_silent_frame(self):
+        audio = (2004, numpy.zeros(3346))
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_correlated_per_lag = 20
+        params[1].samples_per_frame = 20
+        params[1].shortest_lag_per_frame = 10
+        results = pyrapt._get_correlations_for_all_lags(audio, 5, 8, params)
+        self.assertEqual([0.0] * 8, results[0])
+        self.assertEqual(0.0, results[1])
+
+    def test_get_nccf_backend(self):
+        audio = (2004, numpy.zeros(3346))
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[0].gpu_min_sample_count = 3000
+        with patch('pyrapt.pyrapt.numba', None):
+            with patch('pyrapt.pyrapt.cupy', None):
+                with patch('pyrapt.pyrapt._nccf', None):
+                    self.assertEqual('numpy',
+                                     pyrapt._get_nccf_backend(audio, params))
+                with patch('pyrapt.pyrapt._nccf', ANY):
+                    self.assertEqual('cython',
+                                     pyrapt._get_nccf_backend(audio, params))
+                params[0].nccf_backend = 'cupy'
+                with self.assertRaises(ValueError):
+                    pyrapt._get_nccf_backend(audio, params)
+            mock_cupy = MagicMock()
+            mock_cupy.cuda.runtime.getDeviceCount.return_value = 1
+            with patch('pyrapt.pyrapt.cupy', mock_cupy), \
+                    patch('pyrapt.pyrapt._nccf', None):
+                params[0].nccf_backend = 'auto'
+                self.assertEqual('cupy',
+                                 pyrapt._get_nccf_backend(audio, params))
+                # cupy w/o a CUDA device (or driver) falls back to the CPU:
+                mock_cupy.cuda.runtime.getDeviceCount.return_value = 0
+                self.assertEqual('numpy',
+                                 pyrapt._get_nccf_backend(audio, params))
+                mock_cupy.cuda.runtime.getDeviceCount.side_effect = \
+                    RuntimeError('no CUDA driver')
+                self.assertEqual('numpy',
+                                 pyrapt._get_nccf_backend(audio, params))
+                # short audio stays on the CPU:
+                mock_cupy.cuda.runtime.getDeviceCount.side_effect = None
+                mock_cupy.cuda.runtime.getDeviceCount.return_value = 1
+                params[0].gpu_min_sample_count = 5000
+                self.assertEqual('numpy',
+                                 pyrapt._get_nccf_backend(audio, params))
+        params[0].nccf_backend = 'opencl'
+        with self.assertRaises(ValueError):
+            pyrapt._get_nccf_backend(audio, params)
+
+    @patch('pyrapt.pyrapt._get_results_per_frame')
+    def test_get_correlations_for_all_frames_numba_kernel(self, mock_frames):
+        audio = (2004, numpy.zeros(3346))
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[0].nccf_backend = 'numba'
+        params[1].max_frame_count = 165
+        with patch('pyrapt.pyrapt.numba', ANY), \
+                patch('pyrapt.pyrapt.joblib', ANY), \
+                patch('pyrapt.pyrapt._nccf_frame_serial', 'serial',
+                      create=True), \
+                patch('pyrapt.pyrapt._nccf_frame', 'parallel'):
+            # frames run in threads must not share numba's parallel runtime:
+            pyrapt._get_correlations_for_all_frames(audio, 8, params)
+            mock_frames.assert_called_with(ANY, audio, 165, -1, 8, params,
+                                           'serial')
+            params[0].n_jobs = 1
+            pyrapt._get_correlations_for_all_frames(audio, 8, params)
+            mock_frames.assert_called_with(ANY, audio, 165, 1, 8, params,
+                                           'parallel')
+
+    def test_nccf_frame_matches_frame_block_correlations(self):
+        audio = (2004, numpy.sin(numpy.arange(3346) * 0.3) * 100.0)
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_correlated_per_lag = 20
+        params[1].samples_per_frame = 20
+        params[1].shortest_lag_per_frame = 10
+        block_results = pyrapt._get_frame_block_correlations(audio, 5, 1, 8,
+                                                             params)[0]
+        kernel_results = pyrapt._nccf_frame(audio[1], 100, 20, 10, 18, 0.0)
+        self.assertEqual(8, len(kernel_results[0]))
+        for k in xrange(0, 8):
+            self.assertAlmostEqual(block_results[k], kernel_results[0][k])
+        self.assertAlmostEqual(block_results.max(), kernel_results[1])
+
+    @skipIf(pyrapt._nccf is None, 'Cython kernel is not built')
+    def test_cython_kernel_matches_frame_block_correlations(self):
+        audio = (2004, numpy.sin(numpy.arange(3346) * 0.3) * 100.0)
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_correlated_per_lag = 20
+        params[1].samples_per_frame = 20
+        params[1].shortest_lag_per_frame = 10
+        block_results = pyrapt._get_frame_block_correlations(audio, 5, 1, 8,
+                                                             params)[0]
+        kernel_results = pyrapt._nccf.nccf_frame(audio[1], 100, 20, 10, 18,
+                                                 0.0)
+        for k in xrange(0, 8):
+            self.assertAlmostEqual(block_results[k], kernel_results[0][k])
+        self.assertAlmostEqual(block_results.max(), kernel_results[1])
+        # the single lag sums back _get_correlation:
+        window = pyrapt._get_frame_window(audio, 5, params)
+        samples, denominator_lag = pyrapt._nccf.lag_sums(audio[1], 112,
+                                                         window[1], window[0])
+        lag_audio = audio[1][112:132] - window[0]
+        self.assertAlmostEqual(numpy.dot(window[1], lag_audio), samples)
+        self.assertAlmostEqual(numpy.dot(lag_audio, lag_audio),
+                               denominator_lag)
 
     # TODO: Test below with lags that go beyond range of the audio sample
     # (logic should be designed to prevent out of range exceptions)
 
-    @patch('pyrapt.pyrapt._get_correlation')
-    def test_get_correlations_for_input_lags(self, mock_get_correlation):
-        mock_get_correlation.return_value = 0.6
+    @patch('pyrapt.pyrapt._get_lag_sums')
+    def test_get_correlations_for_input_lags(self, mock_get_lag_sums):
+        # the frame is silent, so only the additive constant (10000) is left
+        # in the denominator and a numerator of 60 gives a correlation of 0.6
+        mock_get_lag_sums.return_value = (60.0, 10000.0)
         audio = (44100, numpy.full(3500, 5.0))
         params = (raptparams.Raptparams(), nccfparams.Nccfparams())
         params[0].sample_rate_ratio = 4
@@ -155,15 +301,35 @@ class TestNccfMethods(TestCase):
         first_pass = [[(32, 0.7)]] * 35
         results = pyrapt._get_correlations_for_input_lags(audio, 5, first_pass,
                                                           lag_range, params)
-        mock_get_correlation.assert_called_with(ANY, ANY, ANY, ANY, False)
+        # frame 5 starts at sample 500:
+        mock_get_lag_sums.assert_called_with(ANY, 542, ANY)
         self.assertEqual(50, len(results[0]))
         self.assertEqual(0.6, results[0][32])
-        self.assertEqual(0.6, results[0][29])
-        self.assertEqual(0.6, results[0][35])
-        self.assertEqual(0.0, results[0][28])
-        self.assertEqual(0.0, results[0][36])
+        self.assertEqual(0.6, results[0][22])
+        self.assertEqual(0.6, results[0][42])
+        self.assertEqual(0.0, results[0][21])
+        self.assertEqual(0.0, results[0][43])
         self.assertEqual(0.6, results[1])
 
+    @patch('pyrapt.pyrapt._get_lag_sums')
+    def test_get_correlations_for_overlapping_input_lags(self,
+                                                         mock_get_lag_sums):
+        mock_get_lag_sums.return_value = (60.0, 10000.0)
+        audio = (44100, numpy.full(3500, 5.0))
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_correlated_per_lag = 20
+        params[1].samples_per_frame = 100
+        params[1].shortest_lag_per_frame = 0
+        first_pass = [[(30, 0.7), (24, 0.6), (33, 0.5)] for i in xrange(35)]
+        results = pyrapt._get_correlations_for_input_lags(audio, 5, first_pass,
+                                                          100, params)
+        # lags 14 - 43 are each only calculated once:
+        self.assertEqual(30, mock_get_lag_sums.call_count)
+        self.assertEqual(0.6, results[0][14])
+        self.assertEqual(0.6, results[0][43])
+        self.assertEqual(0.0, results[0][13])
+        self.assertEqual(0.0, results[0][44])
+
     def test_get_marked_results(self):
         candidates = ([0.7, 0.2, 0.6, 0.8], 1.0)
         params = (raptparams.Raptparams(), nccfparams.Nccfparams())
@@ -215,6 +381,46 @@ class TestNccfMethods(TestCase):
         correlation = pyrapt._get_correlation(audio, 0, 1, params, False)
         self.assertEqual(0.7856742013183862, correlation)
 
+    def test_get_frame_window(self):
+        audio = (10, numpy.array([0, 1, 2, 3, 4, 5, 6, 7]))
+        params = (raptparams.Raptparams(), nccfparams.Nccfparams())
+        params[1].samples_per_frame = 2
+        params[1].samples_correlated_per_lag = 5
+        frame_window = pyrapt._get_frame_window(audio, 1, params)
+        self.assertEqual(4.0, frame_window[0])
+        self.assertTrue(numpy.array_equal(numpy.array([-2, -1, 0, 1, 2]),
+                                          frame_window[1]))
+        self.assertEqual(10.0, frame_window[2])
+        # a running sum of the audio should give the same window:
+        params[1].cumulative_audio_sum = numpy.concatenate(
+            ([0.0], numpy.cumsum(audio[1])))
+        summed_window = pyrapt._get_frame_window(audio, 1, params)
+        self.assertEqual(frame_window[0], summed_window[0])
+        self.assertEqual(frame_window[2], summed_window[2])
+        # passing in the frame window should give the same correlation:
+        self.assertEqual(pyrapt._get_correlation(audio, 1, 1, params),
+                         pyrapt._get_correlation(audio, 1, 1, params, True,
+                                                 frame_window))
+        # float32 audio is centered in float64, for float64 sums:
+        float_audio = (10, audio[1].astype(numpy.float32))
+        float_window = pyrapt._get_frame_window(float_audio, 1, params)
+        self.assertEqual(numpy.float64, float_window[1].dtype)
+        self.assertEqual(10.0, float_window[2])
+
+    def test_get_parabolic_peak(self):
+        lags = (84, 106, 128)
+        vals = (0.41, 0.83, 0.62)
+        para = numpy.polyfit(lags, vals, 2)
+        expected_lag = int(round(-para[1] / (2 * para[0])))
+        expected_corr = (para[0] * expected_lag**2 + para[1] * expected_lag +
+                         para[2])
+        peak = pyrapt._get_parabolic_peak(lags, vals)
+        self.assertEqual(expected_lag, peak[0])
+        self.assertAlmostEqual(expected_corr, peak[1])
+        # points on a line have no vertex to interpolate:
+        self.assertEqual(None, pyrapt._get_parabolic_peak(lags,
+                                                          (0.25, 0.5, 0.75)))
+
     # TODO: Improve get_peak_lag_val testing
 
     # def test_get_peak_lag(self):
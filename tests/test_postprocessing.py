@@ -4,6 +4,7 @@ Unit tests for postprocessing dynamic programming steps used by rapt
 from unittest import TestCase
 from mock import patch
 from mock import ANY
+import math
 import numpy
 from pyrapt import pyrapt
 from pyrapt import raptparams
@@ -27,50 +28,120 @@ class TestPostProcessingMethods(TestCase):
 
     @patch('pyrapt.pyrapt._process_candidates')
     def test_determine_state_per_frame(self, mock_process):
-        mock_process.return_value = [[(25, (172, 0.5423))]] * 166
+        mock_process.return_value = (numpy.array([25, 30, 35]),
+                                     [numpy.array([1, 1, 0])] * 166)
         raptparam = raptparams.Raptparams()
-        nccf_results = [[(172, 0.5423), (770, 0.6772)]] * 166
+        nccf_results = [[(172, 0.5423), (770, 0.6772)] for i in xrange(166)]
         candidates = pyrapt._determine_state_per_frame(nccf_results, raptparam,
                                                        44100)
         self.assertEqual(166, len(candidates))
-        mock_process.assert_called_once_with(165, [], nccf_results, raptparam,
-                                             44100)
+        self.assertEqual(172, candidates[165])
+        self.assertEqual(770, candidates[164])
+        mock_process.assert_called_once_with(ANY, raptparam, 44100)
+        # candidates should be passed to processing as padded arrays:
+        lags, corrs, log_lags, is_voiced, mask = mock_process.call_args[0][0]
+        self.assertEqual((166, 3), lags.shape)
+        self.assertEqual([172, 770, 0], list(lags[0]))
+        self.assertEqual(0.5423, corrs[0][0])
+        self.assertEqual(math.log(172), log_lags[0][0])
+        self.assertEqual([True, True, False], list(is_voiced[0]))
+        # unvoiced hypothesis should have been added to each frame:
+        self.assertEqual((0, 0.0), nccf_results[0][2])
+        self.assertEqual([], pyrapt._determine_state_per_frame([], raptparam,
+                                                               44100))
+
+    def test_get_candidate_trellis(self):
+        nccf_results = [[(172, 0.54), (0, 0.0)],
+                        [(190, 0.7), (350, 0.4), (0, 0.0)]]
+        lags, corrs, log_lags, is_voiced, mask = \
+            pyrapt._get_candidate_trellis(nccf_results)
+        self.assertEqual([[172, 0, -1], [190, 350, 0]], lags.tolist())
+        self.assertEqual([[0.54, 0.0, 0.0], [0.7, 0.4, 0.0]], corrs.tolist())
+        self.assertEqual(math.log(350), log_lags[1][1])
+        self.assertEqual(0.0, log_lags[0][1])
+        self.assertEqual(0.0, log_lags[0][2])
+        self.assertEqual([[True, False, False], [True, True, False]],
+                         is_voiced.tolist())
+        self.assertEqual([[True, True, False], [True, True, True]],
+                         mask.tolist())
 
     @patch('pyrapt.pyrapt._calculate_costs_per_frame')
     def test_process_candidates(self, mock_calc_frame):
-        mock_calc_frame.return_value = [(25, (172, 0.542)), (55, (770, 0.672))]
+        mock_calc_frame.return_value = (numpy.array([25, 55, 60]),
+                                        numpy.array([0, 1, 1]))
         raptparam = raptparams.Raptparams()
-        nccf_results = [[(172, 0.5423), (770, 0.6772)]] * 166
-        candidates = pyrapt._process_candidates(165, [], nccf_results,
-                                                raptparam, 44100)
-        mock_calc_frame.assert_called_with(ANY, ANY, nccf_results, raptparam,
-                                           44100)
-        self.assertEqual(166, len(candidates))
+        trellis = pyrapt._get_candidate_trellis(
+            [[(172, 0.5423), (770, 0.6772), (0, 0.0)]] * 166)
+        with patch('pyrapt.pyrapt._get_delta_costs') as mock_delta:
+            mock_delta.return_value = numpy.zeros((3, 3))
+            final_costs, pointers = pyrapt._process_candidates(trellis,
+                                                               raptparam,
+                                                               44100)
+            mock_delta.assert_called_with(ANY, ANY, 165, raptparam)
+        mock_calc_frame.assert_called_with(ANY, mock_delta.return_value,
+                                           ANY)
+        self.assertEqual(166, len(pointers))
+        self.assertEqual([0, 1, 1], list(pointers[165]))
+        self.assertEqual(55, final_costs[1])
 
-    @patch('pyrapt.pyrapt._select_max_correlation_for_frame')
-    def test_calculate_cost_per_frame(self, mock_max_for_frame):
-        mock_max_for_frame.return_value = 0.6772
+    def test_process_candidates_many_frames(self):
+        # long audio must not hit python's recursion limit
         raptparam = raptparams.Raptparams()
-        raptparam = (44100, [2.0] * 73000)
-        nccf_results = [[(172, 0.5423), (770, 0.6772)]] * 166
-        with patch('pyrapt.pyrapt._calculate_local_cost') as mock_local:
-            with patch('pyrapt.pyrapt._get_best_cost') as mock_best:
-                mock_local.return_value = 25
-                mock_best.return_value = 75
-                candidates = pyrapt._calculate_costs_per_frame(100, [],
-                                                               nccf_results,
-                                                               raptparam, 44100)
-                self.assertEqual(2, len(candidates))
-                mock_max_for_frame.assert_called_once_with([(172, 0.5423),
-                                                            (770, 0.6772)])
-                mock_local.assert_called_with(ANY, 0.6772, raptparam, 44100)
-                mock_best.assert_called_with(ANY, ANY, [], 100, raptparam)
-
-    def test_select_max_correlation(self):
-        nccf_results_frame = [(172, 0.5423), (235, 0.682), (422, 0.51),
-                              (533, 0.822), (0, 0.0)]
-        max_cand = pyrapt._select_max_correlation_for_frame(nccf_results_frame)
-        self.assertEqual(0.822, max_cand)
+        raptparam.original_audio = (2000, numpy.full(60000, 2.0))
+        raptparam.samples_per_frame = 20
+        raptparam.hanning_window_length = 60
+        raptparam.hanning_window_vals = numpy.hanning(60)
+        raptparam.rms_offset = 20
+        trellis = pyrapt._get_candidate_trellis(
+            [[(172, 0.5423), (0, 0.0)] for i in xrange(3000)])
+        final_costs, pointers = pyrapt._process_candidates(trellis, raptparam,
+                                                           2000)
+        self.assertEqual(3000, len(pointers))
+        self.assertEqual(2, len(final_costs))
+
+    def test_calculate_cost_per_frame(self):
+        prev_costs = numpy.array([5.0, 1.0, 3.0])
+        delta_costs = numpy.array([[1.0, 6.0, 3.0],
+                                   [2.0, 7.0, 1.0]])
+        local_costs = numpy.array([25.0, 25.0])
+        costs, pointers = pyrapt._calculate_costs_per_frame(prev_costs,
+                                                            delta_costs,
+                                                            local_costs)
+        self.assertEqual(2, len(costs))
+        # ties go to the last of the equally cheap previous entries:
+        self.assertEqual([2, 2], list(pointers))
+        self.assertEqual([31.0, 29.0], list(costs))
+        # padded previous entries have an infinite cost and are never picked:
+        prev_costs = numpy.array([5.0, numpy.inf, 3.0])
+        costs, pointers = pyrapt._calculate_costs_per_frame(prev_costs,
+                                                            delta_costs,
+                                                            local_costs)
+        self.assertEqual([2, 2], list(pointers))
+
+    def test_get_best_path(self):
+        trellis = pyrapt._get_candidate_trellis(
+            [[(172, 0.54), (0, 0.0)], [(180, 0.61), (0, 0.0)],
+             [(190, 0.7), (350, 0.4), (0, 0.0)]])
+        final_costs = numpy.array([1.9, 1.5, 1.5])
+        frame_pointers = numpy.array([[0, 1, 0], [1, 0, 0], [0, 1, 0]])
+        lags = pyrapt._get_best_path(trellis, final_costs, frame_pointers)
+        # first lowest cost in final frame wins, then follow the pointers:
+        self.assertEqual([172, 0, 350], lags)
+        self.assertEqual([], pyrapt._get_best_path(None, [], []))
+
+    def test_get_local_costs(self):
+        raptparam = raptparams.Raptparams()
+        trellis = pyrapt._get_candidate_trellis(
+            [[(172, 0.5423), (235, 0.682), (0, 0.0)], [(0, 0.0)]])
+        costs = pyrapt._get_local_costs(trellis, raptparam, 44100)
+        self.assertEqual((2, 3), costs.shape)
+        self.assertEqual(pyrapt._calculate_local_cost((235, 0.682), 0.682,
+                                                      raptparam, 44100),
+                         costs[0][1])
+        # unvoiced cost uses the largest correlation val in the frame:
+        self.assertEqual(raptparam.voicing_bias + 0.682, costs[0][2])
+        self.assertEqual(raptparam.voicing_bias, costs[1][0])
+        self.assertEqual(numpy.inf, costs[1][1])
 
     def test_calculate_local_cost(self):
         # standard voiced hypothesis calc:
@@ -88,41 +159,60 @@ class TestPostProcessingMethods(TestCase):
                                             raptparam, sample_rate)
         self.assertEqual(10.682, cost)
 
-    @patch('pyrapt.pyrapt._get_delta_cost')
-    def test_get_best_cost(self, mock_delta):
-        mock_delta.return_value = 25
-        candidate = (172, 0.542)
+    def test_get_delta_costs(self):
+        candidates = (numpy.array([math.log(172), 0.0]),
+                      numpy.array([True, False]))
+        prev_candidates = (numpy.array([0.0, math.log(215), math.log(344)]),
+                           numpy.array([False, True, True]))
         params = raptparams.Raptparams()
-        params.original_audio = (44100, [2.0] * 73000)
-        cost = pyrapt._get_best_cost(candidate, 25, [], 100, params)
-        self.assertEqual(50, cost)
-
-    def test_get_delta_cost(self):
-        cand1 = (172, 0.542)
-        cand2 = (0, 0.0)
-        prev_cand1 = (10, (215, 0.211))
-        prev_cand2 = (10, (0, 0.0))
+        with patch('pyrapt.pyrapt._get_rms_ratio') as mock_rms:
+            mock_rms.return_value = 2.0
+            params.transition_cost = 10.0
+            params.amp_mod_transition_cost = 4.0
+            delta = pyrapt._get_delta_costs(candidates, prev_candidates, 25,
+                                            params)
+            # rms ratio is only needed once for the whole frame, when there
+            # are voicing transitions between the frames' candidates:
+            mock_rms.assert_called_once_with(25, params)
+        self.assertEqual((2, 3), delta.shape)
+        self.assertEqual(12, delta[0][0])
+        self.assertAlmostEqual(pyrapt._get_voiced_to_voiced_cost(
+            math.log(172), math.log(215), params), delta[0][1])
+        self.assertAlmostEqual(pyrapt._get_voiced_to_voiced_cost(
+            math.log(172), math.log(344), params), delta[0][2])
+        self.assertEqual(0.0, delta[1][0])
+        self.assertEqual(18, delta[1][1])
+        self.assertEqual(18, delta[1][2])
+
+    def test_get_delta_costs_unvoiced_only(self):
+        # frames of digital silence only have the unvoiced hypothesis, and
+        # the rms ratio (undefined for silence) must not be calculated:
+        candidates = (numpy.array([0.0]), numpy.array([False]))
         params = raptparams.Raptparams()
-        with patch('pyrapt.pyrapt._get_unvoiced_to_unvoiced_cost') as mok_cost1:
-            mok_cost1.return_value = 5
-            cost = pyrapt._get_delta_cost(cand2, prev_cand2, 25, params)
-            self.assertEquals(5, cost)
-            mok_cost1.assert_called_once_with(prev_cand2)
-        with patch('pyrapt.pyrapt._get_voiced_to_unvoiced_cost') as mok_cost2:
-            mok_cost2.return_value = 10
-            cost = pyrapt._get_delta_cost(cand2, prev_cand1, 25, params)
-            self.assertEquals(10, cost)
-            mok_cost2.assert_called_once_with(cand2, prev_cand1, 25, params)
-        with patch('pyrapt.pyrapt._get_unvoiced_to_voiced_cost') as mok_cost3:
-            mok_cost3.return_value = 15
-            cost = pyrapt._get_delta_cost(cand1, prev_cand2, 25, params)
-            self.assertEquals(15, cost)
-            mok_cost3.assert_called_once_with(cand1, prev_cand2, 25, params)
-        with patch('pyrapt.pyrapt._get_voiced_to_voiced_cost') as mok_cost4:
-            mok_cost4.return_value = 25
-            cost = pyrapt._get_delta_cost(cand1, prev_cand1, 25, params)
-            self.assertEquals(25, cost)
-            mok_cost4.assert_called_once_with(cand1, prev_cand1, params)
+        with patch('pyrapt.pyrapt._get_rms_ratio') as mock_rms:
+            delta = pyrapt._get_delta_costs(candidates, candidates, 25,
+                                            params)
+            self.assertFalse(mock_rms.called)
+        self.assertEqual([[0.0]], delta.tolist())
+
+    def test_process_candidates_silent_gap(self):
+        # a stretch of silence in the middle of the audio must not raise a
+        # ZeroDivisionError while calculating the rms ratio:
+        audio = numpy.sin(numpy.arange(6000) * 0.3) * 100.0
+        audio[2000:4000] = 0.0
+        raptparam = raptparams.Raptparams()
+        raptparam.original_audio = (2000, audio)
+        raptparam.samples_per_frame = 20
+        raptparam.hanning_window_length = 60
+        raptparam.hanning_window_vals = numpy.hanning(60)
+        raptparam.rms_offset = 20
+        nccf_results = [[(21, 0.9)] for i in xrange(300)]
+        for i in xrange(100, 200):
+            nccf_results[i] = []
+        candidates = pyrapt._determine_state_per_frame(nccf_results,
+                                                       raptparam, 2000)
+        self.assertEqual(300, len(candidates))
+        self.assertEqual([0] * 90, candidates[105:195])
 
     def test_is_unvoiced(self):
         voiced_cand = (172, 0.542)
@@ -135,42 +225,24 @@ class TestPostProcessingMethods(TestCase):
         self.assertFalse(pyrapt._is_unvoiced(partial_cand2))
 
     def test_voiced_to_voiced(self):
-        candidate = (709, 0.733)
-        prev_entry = (0.373, (650, 0.841))
         params = raptparams.Raptparams()
-        cost = pyrapt._get_voiced_to_voiced_cost(candidate, prev_entry, params)
-        self.assertEqual(0.39212528033835004, cost)
-
-    def test_unvoiced_to_unvoiced(self):
-        prev_entry = (0.373, (0, 0.0))
-        cost = pyrapt._get_unvoiced_to_unvoiced_cost(prev_entry)
-        self.assertEqual(0.373, cost)
-
-    @patch('pyrapt.pyrapt._get_rms_ratio')
-    def test_voiced_to_unvoiced(self, mock_rms):
-        mock_rms.return_value = 2.0
-        candidate = (709, 0.733)
-        prev_entry = (0.373, (650, 0.841))
+        cost = pyrapt._get_voiced_to_voiced_cost(math.log(709), math.log(650),
+                                                 params)
+        self.assertAlmostEqual(0.01912528033835004, cost)
+
+    def test_voiced_to_unvoiced(self):
         params = raptparams.Raptparams()
         params.transition_cost = 10.0
         params.amp_mod_transition_cost = 4.0
-        cost = pyrapt._get_voiced_to_unvoiced_cost(candidate, prev_entry,
-                                                   100, params)
-        mock_rms.assert_called_once_with(100, params)
-        self.assertEqual(18.373, cost)
-
-    @patch('pyrapt.pyrapt._get_rms_ratio')
-    def test_unvoiced_to_voiced(self, mock_rms):
-        mock_rms.return_value = 2.0
-        candidate = (709, 0.733)
-        prev_entry = (0.373, (650, 0.841))
+        cost = pyrapt._get_voiced_to_unvoiced_cost(2.0, params)
+        self.assertEqual(18.0, cost)
+
+    def test_unvoiced_to_voiced(self):
         params = raptparams.Raptparams()
         params.transition_cost = 10.0
         params.amp_mod_transition_cost = 4.0
-        cost = pyrapt._get_unvoiced_to_voiced_cost(candidate, prev_entry,
-                                                   100, params)
-        mock_rms.assert_called_once_with(100, params)
-        self.assertEqual(12.373, cost)
+        cost = pyrapt._get_unvoiced_to_voiced_cost(2.0, params)
+        self.assertEqual(12.0, cost)
 
     # def test_spec_stationarity(self):
     #    result = pyrapt._get_spec_stationarity()
@@ -115,6 +115,7 @@ class TestUtilityMethods(TestCase):
         self.assertEqual(100, sample_rate)
         self.assertEqual(5, audio_sample.shape[0])
         self.assertEqual(1, audio_sample[0])
+        self.assertEqual(numpy.float32, audio_sample.dtype)
 
     @patch('scipy.io.wavfile.read')
     def test_read_data_with_mono_conversion(self, mock_wavfile_read):
@@ -131,15 +132,24 @@ class TestUtilityMethods(TestCase):
         with self.assertRaises(ValueError):
             pyrapt._calculate_downsampling_rate(500, 500)
 
-    @patch('scipy.signal.resample')
+    @patch('scipy.signal.resample_poly')
     def test_basic_audio_downsampling(self, mock_signal_resample):
         mock_sample = numpy.array([1, 2, 3])
         mock_signal_resample.return_value = mock_sample
         input_array = numpy.array([1, 2, 3, 4, 5])
         x = pyrapt._downsample_audio((100, input_array), 10)
-        mock_signal_resample.assert_called_once_with(input_array, .5)
+        mock_signal_resample.assert_called_once_with(input_array, 1, 10)
         self.assertTrue(numpy.array_equal(numpy.array([1, 2, 3]), x))
 
+    @patch('scipy.signal.resample')
+    def test_fft_audio_downsampling(self, mock_signal_resample):
+        mock_sample = numpy.array([1, 2])
+        mock_signal_resample.return_value = mock_sample
+        input_array = numpy.arange(20)
+        x = pyrapt._downsample_audio((100, input_array), 10, False)
+        mock_signal_resample.assert_called_once_with(input_array, 2)
+        self.assertTrue(numpy.array_equal(numpy.array([1, 2]), x))
+
     @patch('scipy.signal.resample')
     def test_downsampling_bad_input_sample_rate(self, mock_signal_resample):
         mock_sample = numpy.array([1, 2, 3])